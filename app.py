@@ -1,152 +1,583 @@
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import Flask, render_template, jsonify
 from flask_cors import CORS
-import threading
+from a2wsgi import WSGIMiddleware
+from playwright.async_api import async_playwright
+import socketio
+import logging
+import logging.handlers
+import queue
 import time
-import base64
 import uuid
 import os
-import subprocess
-import sys
 import secrets
 import asyncio
+import base64
+import functools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import orjson
+import xxhash
+from tile_encoder import TILE_SIZE, encode_tiles
+
+log = logging.getLogger('comic-sync')
+
+log_listener = None
+
+def setup_logging():
+    """Route log records through a queue so output is written on a background thread"""
+    global log_listener
+    if log_listener is not None:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    
+    log_listener = logging.handlers.QueueListener(log_queue, handler)
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(os.environ.get('LOG_LEVEL', 'WARNING').upper())
+    log.propagate = False
+    log_listener.start()
+
+def stop_logging():
+    """Flush queued records and stop the background writer"""
+    global log_listener
+    if log_listener is None:
+        return
+    
+    log_listener.stop()
+    log_listener = None
+    for handler in log.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            log.removeHandler(handler)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_hex(32))
 
 CORS(app, origins="*")
 
-socketio = SocketIO(
-    app, 
-    cors_allowed_origins="*", 
-    async_mode='threading',
+class OrjsonCodec:
+    """The json module interface Socket.IO expects, backed by orjson"""
+    @staticmethod
+    def dumps(obj, **kwargs):
+        # orjson output is already compact, so separators and the like are ignored
+        return orjson.dumps(obj).decode()
+    
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+# Socket.IO and every room's Playwright page share one asyncio event loop
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    json=OrjsonCodec,
+    # Control handlers only queue browser commands, so run them inline in each
+    # client's reader instead of spawning a task per event
+    async_handlers=False,
+    cors_allowed_origins="*",
     ping_timeout=60,
     ping_interval=25
 )
 
-rooms_data = {}
+rooms = {}  # room code -> Room
 user_sessions = {}
-browser_instances = {}
+
+BASELINE_INTERVAL = 100  # Emitted frames between full baselines
+WEBP_QUALITY = 70
+FRAME_ACK_TIMEOUT = 0.25  # Seconds to wait for clients to ack a frame before sending the next
+# Rooms whose clients ack slowly get lighter frames until the ack time recovers
+SLOW_ACK = 0.1  # Seconds; an ack-time average above this degrades the stream
+FAST_ACK = 0.03  # Seconds; an average below this restores it
+DEGRADED_WEBP_QUALITY = 50
+DEGRADED_FRAME_SKIP = 2  # Screencast everyNthFrame while degraded
+MAX_PENDING_COMMANDS = 4  # Hold frames back while more commands than this are queued
+PAGE_INFO_UPDATE_DELAY = 0.1  # Seconds; page events inside this window share one page-info-update
+ACTION_TIMEOUT_MS = 5000
+NAVIGATION_TIMEOUT_MS = 15000
+# Contexts only give memory back when closed, so long-lived rooms get a fresh one
+CONTEXT_MAX_NAVIGATIONS = 50
+CONTEXT_MAX_AGE = 30 * 60  # Seconds
+
+# Chromium flags for the shared browser
+CHROMIUM_LAUNCH_ARGS = (
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    '--disable-web-security',
+    '--autoplay-policy=no-user-gesture-required',
+    '--enable-smooth-scrolling',
+    '--enable-accelerated-video-decode',
+    '--enable-gpu-rasterization',
+    '--disable-background-timer-throttling',
+    '--disable-backgrounding-occluded-windows',
+    '--disable-renderer-backgrounding',
+    '--allow-running-insecure-content',
+    '--disable-blink-features=AutomationControlled',
+    '--disable-features=VizDisplayCompositor'
+)
+
+# Runs in every document a room's context opens and pushes page info only when it changes
+PAGE_INFO_SCRIPT = """
+(() => {
+    if (window !== window.top) return;
+    
+    const readPageInfo = () => {
+        const scrollX = window.pageXOffset || document.documentElement.scrollLeft || 0;
+        const scrollY = window.pageYOffset || document.documentElement.scrollTop || 0;
+        const maxScrollX = Math.max(0, (document.documentElement.scrollWidth || 0) - window.innerWidth);
+        const maxScrollY = Math.max(0, (document.documentElement.scrollHeight || 0) - window.innerHeight);
+
+        // Check for video elements
+        const videos = document.querySelectorAll('video');
+        let hasVideo = false;
+        for (let video of videos) {
+            if (!video.paused && !video.ended && video.currentTime > 0) {
+                hasVideo = true;
+                break;
+            }
+        }
+
+        // Get focused element info
+        const activeElement = document.activeElement;
+        const focusedElement = activeElement ? {
+            tagName: activeElement.tagName,
+            type: activeElement.type || null,
+            id: activeElement.id || null,
+            className: activeElement.className || null
+        } : null;
+
+        return {
+            scroll: {
+                x: scrollX,
+                y: scrollY,
+                maxX: maxScrollX,
+                maxY: maxScrollY
+            },
+            page: {
+                width: document.documentElement.scrollWidth || 1920,
+                height: document.documentElement.scrollHeight || 1080,
+                viewportWidth: window.innerWidth,
+                viewportHeight: window.innerHeight
+            },
+            media: {
+                hasVideo: hasVideo
+            },
+            focus: focusedElement,
+            url: window.location.href,
+            title: document.title
+        };
+    };
+    
+    // Bursts of scrolls and mutations are sent at most once per animation frame
+    let queued = false;
+    const send = () => {
+        if (queued) return;
+        queued = true;
+        requestAnimationFrame(() => {
+            queued = false;
+            window.pnState(readPageInfo());
+        });
+    };
+    
+    const watch = () => {
+        new MutationObserver(send).observe(document.documentElement, { subtree: true, childList: true });
+        send();
+    };
+    
+    addEventListener('scroll', send, { passive: true });
+    addEventListener('resize', send);
+    document.addEventListener('focusin', send);
+    document.addEventListener('focusout', send);
+    document.addEventListener('visibilitychange', send);
+    // Media events don't bubble, so catch them on the way down
+    for (const type of ['play', 'pause', 'ended']) {
+        document.addEventListener(type, send, true);
+    }
+    
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', watch);
+    } else {
+        watch();
+    }
+})();
+"""
+
+# Tile diffing runs in worker processes so it neither blocks the loop nor holds its GIL
+encode_pool = None
+
+def get_encode_pool():
+    """Return the process pool shared by every room, starting it on first use"""
+    global encode_pool
+    
+    if encode_pool is None:
+        # Spawned rather than forked: the server process runs threads and a Playwright driver
+        encode_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context('spawn')
+        )
+    return encode_pool
+
+def reset_encode_pool(pool):
+    """Drop a pool whose worker died, so the next frame starts a fresh one"""
+    global encode_pool
+    
+    # Several rooms can hit the same broken pool; only the first replaces it
+    if encode_pool is pool:
+        encode_pool = None
+        pool.shutdown(wait=False)
+
+# One Chromium process is shared by every room; each room gets its own context
+shared_playwright = None
+shared_browser = None
+shared_browser_lock = None  # asyncio.Lock, created on the event loop
+shared_browser_rooms = 0  # Rooms holding the shared browser; it closes when this drops to zero
+
+def get_shared_browser_lock():
+    """Return the lock guarding the shared browser, creating it on first use"""
+    global shared_browser_lock
+    
+    if shared_browser_lock is None:
+        shared_browser_lock = asyncio.Lock()
+    return shared_browser_lock
+
+async def _launch_shared_browser():
+    """Launch the shared Chromium browser unless it is already up; the caller holds the lock"""
+    global shared_playwright, shared_browser
+    
+    if shared_browser is not None and shared_browser.is_connected():
+        return shared_browser
+    
+    log.info("🎭 Launching shared Playwright browser")
+    
+    # Start Playwright
+    if shared_playwright is None:
+        shared_playwright = await async_playwright().start()
+    
+    # Launch browser with all features enabled
+    shared_browser = await shared_playwright.chromium.launch(
+        headless=True,
+        args=CHROMIUM_LAUNCH_ARGS
+    )
+    return shared_browser
+
+async def _close_shared_browser():
+    """Close the shared browser and stop Playwright; the caller holds the lock"""
+    global shared_playwright, shared_browser
+    
+    try:
+        if shared_browser is not None:
+            log.info("🛑 Closing shared Playwright browser")
+            await shared_browser.close()
+        if shared_playwright is not None:
+            await shared_playwright.stop()
+    except Exception as e:
+        log.error("❌ Shared browser shutdown error: %s", e)
+    
+    shared_browser = None
+    shared_playwright = None
+
+async def acquire_shared_browser():
+    """Return the shared browser for a room, launching it if needed"""
+    global shared_browser_rooms
+    
+    async with get_shared_browser_lock():
+        browser = await _launch_shared_browser()
+        shared_browser_rooms += 1
+        return browser
+
+async def release_shared_browser():
+    """Give up a room's hold on the shared browser, closing it after the last room"""
+    global shared_browser_rooms
+    
+    async with get_shared_browser_lock():
+        shared_browser_rooms = max(0, shared_browser_rooms - 1)
+        if shared_browser_rooms == 0:
+            await _close_shared_browser()
+
+async def on_startup():
+    """Launch the shared browser up front so the first room opens quickly"""
+    # Here rather than at import, so it runs however the app is served and never in encoder workers
+    setup_logging()
+    try:
+        async with get_shared_browser_lock():
+            await _launch_shared_browser()
+    except Exception as e:
+        log.warning("⚠️ Shared browser not started: %s", e)
+
+async def on_shutdown():
+    """Close the shared browser and encoder processes, then flush logging, when the server stops"""
+    async with get_shared_browser_lock():
+        await _close_shared_browser()
+    
+    if encode_pool is not None:
+        encode_pool.shutdown(wait=False)
+    
+    stop_logging()
+
+asgi_app = socketio.ASGIApp(
+    sio,
+    other_asgi_app=WSGIMiddleware(app),
+    on_startup=on_startup,
+    on_shutdown=on_shutdown
+)
+
+class BrowserStopped(Exception):
+    """Raised inside browser setup when the room was stopped while it awaited"""
+
+class Room:
+    """Everything the server keeps for one room, looked up once per event"""
+    __slots__ = ('users', 'messages', 'browser', 'webtoon_url', 'created_at', 'creator')
+    
+    def __init__(self, webtoon_url, creator):
+        self.users = {}  # sid -> {'id', 'userName'}
+        self.messages = deque(maxlen=100)
+        self.browser = None
+        self.webtoon_url = webtoon_url
+        self.created_at = time.time()
+        self.creator = creator
 
 class FullVirtualBrowser:
     def __init__(self, room_code, url):
         self.room_code = room_code
         self.url = url
         self.is_running = False
+        self.is_stopped = False  # Set by stop(); setup checks it after every await
         self.page = None
-        self.browser = None
+        self.browser = None  # Shared Chromium instance
         self.context = None
-        self.playwright = None
+        self.context_lock = asyncio.Lock()  # Held while the context is replaced or closed
+        self.context_started_at = 0.0
+        self.navigation_count = 0  # User navigations in the current context
         self.loop = None
-        self.thread = None
         self.current_url = url
         self.page_title = ""
         self.can_go_back = False
         self.can_go_forward = False
         self.is_loading = False
         self.user_is_typing_url = False  # Track if user is typing in URL bar
+        self.page_info_update = None  # Timer for the next coalesced page-info-update
+        self.cdp = None  # CDP session that streams screencast frames
+        self.executor = ThreadPoolExecutor(max_workers=1)  # Keeps frame decoding off the shared loop
+        self.last_hash = None  # Hash of the last emitted frame
+        self.last_screencast_hash = None  # Hash of the last screencast frame received
+        self.band_hashes = None  # Per-row-of-tiles hashes of the last emitted frame
+        self.tile_hashes = None  # Per-tile hashes of the last emitted frame
+        self.needs_baseline = True
+        self.frames_since_baseline = 0
+        # Reused for every frame; frame_lock keeps it from changing mid-emit
+        self.frame_lock = asyncio.Lock()
+        self.frame_data = {
+            'tiles': None,
+            'baseline': False,
+            'tileSize': TILE_SIZE,
+            'width': 0,
+            'height': 0,
+            'pageInfo': None,
+            'timestamp': 0.0,
+            'technology': 'Playwright Full'
+        }
+        self.page_info = None  # Cached scroll/focus/url info from the page
+        self.frame_index = 0
+        self.last_frame = None  # Newest (png_bytes, page_info), re-sent to late joiners
+        # Backpressure: one frame in flight, and only the newest raw frame waits behind it
+        self.frame_in_flight = False
+        self.pending_frame = None
+        self.frame_seq = 0
+        self.acks_outstanding = 0
+        self.ack_timer = None
+        self.frame_sent_at = 0.0
+        self.ack_time_avg = 0.0  # Moving average of how long clients take to ack a frame
+        self.degraded = False
+        self.webp_quality = WEBP_QUALITY
+        self.frame_skip = 1  # Screencast everyNthFrame
+        self.commands = deque()  # Pending (coroutine function, args) commands
+        self.command_event = None  # Set when commands arrive
         
     def start(self):
         """Start full-featured browser"""
         try:
-            print(f"🚀 Starting FULL virtual browser for room {self.room_code}")
+            log.info("🚀 Starting FULL virtual browser for room %s", self.room_code)
             
-            self.thread = threading.Thread(target=self._run_browser_thread, daemon=True)
-            self.thread.start()
+            self.loop = asyncio.get_running_loop()
+            self.loop.create_task(self._setup_browser())
             
             return True
             
         except Exception as e:
-            print(f"❌ Error starting browser: {str(e)}")
-            socketio.emit('browser-error', {'error': str(e)}, room=self.room_code)
+            log.error("❌ Error starting browser: %s", e)
             return False
     
-    def _run_browser_thread(self):
-        """Run browser in its own thread with event loop"""
-        try:
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            
-            self.loop.run_until_complete(self._setup_browser())
-            self.loop.run_forever()
-            
-        except Exception as e:
-            print(f"❌ Browser thread error: {str(e)}")
-            socketio.emit('browser-error', {'error': str(e)}, room=self.room_code)
-    
     async def _setup_browser(self):
         """Setup full-featured browser with Playwright"""
         try:
-            # Install Playwright if needed
-            try:
-                from playwright.async_api import async_playwright
-            except ImportError:
-                print("📦 Installing Playwright...")
-                subprocess.run([sys.executable, "-m", "pip", "install", "playwright"], check=True)
-                subprocess.run([sys.executable, "-m", "playwright", "install", "chromium"], check=True)
-                from playwright.async_api import async_playwright
-            
-            print(f"🎭 Starting FULL Playwright browser for room {self.room_code}")
-            
-            # Start Playwright
-            self.playwright = await async_playwright().start()
-            
-            # Launch browser with all features enabled
-            self.browser = await self.playwright.chromium.launch(
-                headless=True,
-                args=[
-                    '--no-sandbox',
-                    '--disable-dev-shm-usage',
-                    '--disable-web-security',
-                    '--autoplay-policy=no-user-gesture-required',
-                    '--enable-smooth-scrolling',
-                    '--enable-accelerated-video-decode',
-                    '--enable-gpu-rasterization',
-                    '--disable-background-timer-throttling',
-                    '--disable-backgrounding-occluded-windows',
-                    '--disable-renderer-backgrounding',
-                    '--allow-running-insecure-content',
-                    '--disable-blink-features=AutomationControlled',
-                    '--disable-features=VizDisplayCompositor'
-                ]
-            )
-            
-            # Create context with full browser features
-            self.context = await self.browser.new_context(
-                viewport={'width': 1920, 'height': 1080},
-                device_scale_factor=1,
-                has_touch=False,
-                is_mobile=False,
-                java_script_enabled=True,
-                accept_downloads=True,
-                ignore_https_errors=True,
-                permissions=['geolocation', 'notifications']
-            )
-            
-            # Create page
-            self.page = await self.context.new_page()
-            
-            # Set up page event listeners
-            await self._setup_page_listeners()
-            
-            print(f"📄 Loading URL: {self.url}")
-            await self.page.goto(self.url, wait_until='domcontentloaded')
+            # Cleanup takes the same lock, so it can't close things halfway through setup
+            async with self.context_lock:
+                try:
+                    log.info("🎭 Opening FULL Playwright context for room %s", self.room_code)
+                    
+                    self.browser = await acquire_shared_browser()
+                    self._check_stopped()
+                    await self._open_context()
+                    
+                    # Stream from the start, so a first load slower than the
+                    # navigation timeout still shows whatever has rendered
+                    self.is_running = True
+                    self.command_event = asyncio.Event()
+                    await self._start_screencast()
+                    self._check_stopped()
+                    
+                    log.debug("📄 Loading URL: %s", self.url)
+                    await self._load_page(self.url)
+                    self._check_stopped()
+                    
+                except BrowserStopped:
+                    # Cleanup may already have run and found nothing, so undo setup here
+                    log.info("🛑 Room %s stopped during browser setup", self.room_code)
+                    await self._release_browser()
+                    return
             
-            self.is_running = True
-            print(f"✅ FULL browser ready for room {self.room_code}")
+            log.info("✅ FULL browser ready for room %s", self.room_code)
             
             # Emit browser ready event
-            socketio.emit('browser-ready', {
+            await sio.emit('browser-ready', {
                 'success': True,
                 'features': ['typing', 'scrolling', 'clicking', 'navigation', 'keyboard_shortcuts']
             }, room=self.room_code)
+            if self.is_stopped:
+                return
+            
+            # Commands queued during the first load run as soon as the loop starts
+            asyncio.create_task(self._command_loop())
+            
+        except Exception as e:
+            log.error("❌ Browser setup error: %s", e)
+            # No command loop will run, so stop queuing input for it
+            self.is_running = False
+            self.commands.clear()
+            await sio.emit('browser-error', {'error': str(e)}, room=self.room_code)
+    
+    def _check_stopped(self):
+        """Abort setup if the room was stopped during the last await"""
+        if self.is_stopped:
+            raise BrowserStopped()
+    
+    async def _release_browser(self):
+        """Close this room's context and give up its hold on the shared browser; hold context_lock"""
+        try:
+            # The browser process is shared, so only this room's context is closed
+            if self.context:
+                await self.context.close()
+        except Exception as e:
+            log.error("❌ Cleanup error: %s", e)
+        self.context = None
+        
+        if self.browser:
+            self.browser = None
+            await release_shared_browser()
+    
+    async def _open_context(self, storage_state=None):
+        """Open this room's context and page on the shared browser"""
+        # Create context with full browser features
+        self.context = await self.browser.new_context(
+            viewport={'width': 1920, 'height': 1080},
+            device_scale_factor=1,
+            has_touch=False,
+            is_mobile=False,
+            java_script_enabled=True,
+            accept_downloads=True,
+            ignore_https_errors=True,
+            permissions=['geolocation', 'notifications'],
+            storage_state=storage_state
+        )
+        self._check_stopped()
+        self.context_started_at = time.monotonic()
+        self.navigation_count = 0
+        
+        # Commands run one after another, so don't let a stuck page hold the queue for long
+        self.context.set_default_timeout(ACTION_TIMEOUT_MS)
+        self.context.set_default_navigation_timeout(NAVIGATION_TIMEOUT_MS)
+        
+        # Page info must be wired up before the first document loads
+        await self._setup_page_info()
+        self._check_stopped()
+        
+        # Create page and a CDP session for the screencast
+        self.page = await self.context.new_page()
+        self._check_stopped()
+        self.cdp = await self.context.new_cdp_session(self.page)
+        self._check_stopped()
+        
+        # Set up page event listeners
+        await self._setup_page_listeners()
+    
+    async def _start_screencast(self):
+        """Have Chromium push a frame whenever the page paints"""
+        self.cdp.on('Page.screencastFrame', self._on_screencast_frame)
+        await self._send_start_screencast()
+    
+    async def _send_start_screencast(self):
+        """Start the screencast with the room's current frame skip"""
+        await self.cdp.send('Page.startScreencast', {
+            'format': 'png',  # Lossless so unchanged tiles hash identically
+            'maxWidth': 1920,
+            'maxHeight': 1080,
+            'everyNthFrame': self.frame_skip
+        })
+    
+    async def _restart_screencast(self):
+        """Apply a new frame skip, which Chromium only reads when the screencast starts"""
+        try:
+            async with self.context_lock:
+                if not self.is_running:
+                    return
+                await self.cdp.send('Page.stopScreencast')
+                await self._send_start_screencast()
+        except Exception as e:
+            log.error("❌ Screencast restart error: %s", e)
+    
+    def _context_is_stale(self):
+        """Whether the context has lived long enough to be recycled"""
+        return (self.navigation_count >= CONTEXT_MAX_NAVIGATIONS or
+                time.monotonic() - self.context_started_at > CONTEXT_MAX_AGE)
+    
+    async def _recycle_context(self):
+        """Swap in a fresh context, keeping cookies and storage; the caller loads a page into it"""
+        async with self.context_lock:
+            if not self.is_running:
+                return
             
-            # Start screenshot loop
-            asyncio.create_task(self._screenshot_loop())
+            log.info("♻️ Recycling browser context for room %s after %s navigations",
+                     self.room_code, self.navigation_count)
             
+            try:
+                state = await self.context.storage_state()
+                await self.context.close()
+                self.context = None
+                await self._open_context(storage_state=state)
+                
+                # Stream before the caller's load so a failed load still leaves the room live
+                await self._start_screencast()
+            except BrowserStopped:
+                # Cleanup is waiting on the lock and closes whatever context was opened
+                return
+            except Exception as e:
+                # The old context is gone (e.g. the shared browser disconnected), so
+                # fail the room rather than retry on a dead context with every input
+                log.error("❌ Context recycle error for room %s: %s", self.room_code, e)
+                self.is_running = False
+                self.navigation_count = 0
+                self.context_started_at = time.monotonic()
+                await self._release_browser()
+                await sio.emit('browser-error', {'error': str(e)}, room=self.room_code)
+    
+    async def _load_page(self, url):
+        """Load a page, logging a failed or slow load instead of raising"""
+        try:
+            await self.page.goto(url, wait_until='domcontentloaded')
         except Exception as e:
-            print(f"❌ Browser setup error: {str(e)}")
-            socketio.emit('browser-error', {'error': str(e)}, room=self.room_code)
+            # Whatever has rendered keeps streaming; users can reload or navigate
+            log.warning("⚠️ Page load for room %s did not finish: %s", self.room_code, e)
     
     async def _setup_page_listeners(self):
         """Setup page event listeners for full browser functionality"""
@@ -179,44 +610,54 @@ class FullVirtualBrowser:
                 self.can_go_back = False
                 self.can_go_forward = False
             
-            print(f"📄 Page loaded: {self.page_title} - {self.current_url}")
-            
-            # Emit page info update (but don't override URL bar if user is typing)
-            socketio.emit('page-info-update', {
-                'url': self.current_url,
-                'title': self.page_title,
-                'canGoBack': self.can_go_back,
-                'canGoForward': self.can_go_forward,
-                'updateUrlBar': not self.user_is_typing_url  # Only update if user isn't typing
-            }, room=self.room_code)
+            log.debug("📄 Page loaded: %s - %s", self.page_title, self.current_url)
+            self._schedule_page_info_update()
             
         except Exception as e:
-            print(f"❌ Page load handler error: {e}")
+            log.error("❌ Page load handler error: %s", e)
     
     async def _on_dom_ready(self, page):
         """Handle DOM ready events"""
         self.is_loading = False
-        socketio.emit('loading-state', {'loading': False}, room=self.room_code)
+        await sio.emit('loading-state', {'loading': False}, room=self.room_code)
     
     async def _on_navigation(self, frame):
         """Handle navigation events"""
         if frame == self.page.main_frame:
             self.current_url = frame.url
-            # Only emit URL change if user isn't typing
-            if not self.user_is_typing_url:
-                socketio.emit('url-changed', {'url': self.current_url}, room=self.room_code)
+            self._schedule_page_info_update()
+    
+    def _schedule_page_info_update(self):
+        """Send page-info-update soon, folding in any other page events that arrive first"""
+        # A pending update is left alone rather than pushed back, so a page that
+        # navigates nonstop still gets an update every PAGE_INFO_UPDATE_DELAY
+        if self.page_info_update is None:
+            self.page_info_update = self.loop.call_later(PAGE_INFO_UPDATE_DELAY, self._emit_page_info_update)
+    
+    def _emit_page_info_update(self):
+        """Emit the latest url, title and history state in one event"""
+        self.page_info_update = None
+        
+        # Don't override the URL bar while a user is typing in it
+        self.loop.create_task(sio.emit('page-info-update', {
+            'url': self.current_url,
+            'title': self.page_title,
+            'canGoBack': self.can_go_back,
+            'canGoForward': self.can_go_forward,
+            'updateUrlBar': not self.user_is_typing_url
+        }, room=self.room_code))
     
     async def _on_console(self, msg):
         """Handle console messages"""
         if msg.type == 'error':
-            print(f"🔴 Browser console error: {msg.text}")
+            log.debug("🔴 Browser console error: %s", msg.text)
     
     async def _on_dialog(self, dialog):
         """Handle browser dialogs (alerts, confirms, prompts)"""
-        print(f"💬 Dialog: {dialog.type} - {dialog.message}")
+        log.debug("💬 Dialog: %s - %s", dialog.type, dialog.message)
         
         # Emit dialog to users
-        socketio.emit('browser-dialog', {
+        await sio.emit('browser-dialog', {
             'type': dialog.type,
             'message': dialog.message
         }, room=self.room_code)
@@ -226,240 +667,345 @@ class FullVirtualBrowser:
     
     async def _on_download(self, download):
         """Handle downloads"""
-        print(f"📥 Download started: {download.suggested_filename}")
-        socketio.emit('download-started', {
+        log.debug("📥 Download started: %s", download.suggested_filename)
+        await sio.emit('download-started', {
             'filename': download.suggested_filename,
             'url': download.url
         }, room=self.room_code)
     
-    async def _take_screenshot(self):
-        """Take a screenshot with full page info"""
+    async def _setup_page_info(self):
+        """Have every page in the context push its scroll/focus/url info on change"""
+        await self.context.expose_binding('pnState', self._on_page_info)
+        await self.context.add_init_script(PAGE_INFO_SCRIPT)
+    
+    def _on_page_info(self, source, page_info):
+        """Cache page info pushed by the page"""
+        self.page_info = page_info
+    
+    async def _on_screencast_frame(self, params):
+        """Handle a frame pushed by Chromium's screencast"""
         try:
-            if not self.page:
+            # Chromium repaints often without changing a pixel; catch those on the
+            # encoded string so identical frames are never decoded or diffed
+            data_hash = xxhash.xxh3_64_intdigest(params['data'])
+            if data_hash == self.last_screencast_hash:
                 return
-                
-            # Take screenshot
-            screenshot_bytes = await self.page.screenshot(
-                type='jpeg',
-                quality=90,
-                full_page=False
-            )
+            self.last_screencast_hash = data_hash
             
-            screenshot_b64 = base64.b64encode(screenshot_bytes).decode('utf-8')
+            # Page info is pushed by the page itself, so frames need no evaluate round-trip
+            png_bytes = await self.loop.run_in_executor(self.executor, base64.b64decode, params['data'])
+            self.frame_index += 1
+            self.last_frame = (png_bytes, self.page_info)
             
-            # Get comprehensive page info
-            page_info = await self.page.evaluate("""
-                () => {
-                    const scrollX = window.pageXOffset || document.documentElement.scrollLeft || 0;
-                    const scrollY = window.pageYOffset || document.documentElement.scrollTop || 0;
-                    const maxScrollX = Math.max(0, (document.documentElement.scrollWidth || 0) - window.innerWidth);
-                    const maxScrollY = Math.max(0, (document.documentElement.scrollHeight || 0) - window.innerHeight);
-                    
-                    // Check for video elements
-                    const videos = document.querySelectorAll('video');
-                    let hasVideo = false;
-                    for (let video of videos) {
-                        if (!video.paused && !video.ended && video.currentTime > 0) {
-                            hasVideo = true;
-                            break;
-                        }
-                    }
-                    
-                    // Get focused element info
-                    const activeElement = document.activeElement;
-                    const focusedElement = activeElement ? {
-                        tagName: activeElement.tagName,
-                        type: activeElement.type || null,
-                        id: activeElement.id || null,
-                        className: activeElement.className || null
-                    } : null;
-                    
-                    return {
-                        scroll: {
-                            x: scrollX,
-                            y: scrollY,
-                            maxX: maxScrollX,
-                            maxY: maxScrollY
-                        },
-                        page: {
-                            width: document.documentElement.scrollWidth || 1920,
-                            height: document.documentElement.scrollHeight || 1080,
-                            viewportWidth: window.innerWidth,
-                            viewportHeight: window.innerHeight
-                        },
-                        media: {
-                            hasVideo: hasVideo
-                        },
-                        focus: focusedElement,
-                        url: window.location.href,
-                        title: document.title
-                    };
-                }
-            """)
+            # Give queued input priority; the command loop sends the newest frame after its batch
+            if len(self.commands) <= MAX_PENDING_COMMANDS:
+                await self._emit_frame(png_bytes, self.page_info)
             
-            # Prepare frame data
-            frame_data = {
-                'screenshot': screenshot_b64,
-                'pageInfo': page_info,
-                'timestamp': time.time(),
-                'technology': 'Playwright Full'
-            }
+            if self.frame_index % 60 == 0:
+                log.debug("📊 Room %s: %s frames received", self.room_code, self.frame_index)
             
-            socketio.emit('screenshot-update', frame_data, room=self.room_code)
+        except Exception as e:
+            log.error("❌ Screencast frame error: %s", e)
+        
+        finally:
+            # Chromium sends the next frame only after this ack, which paces the screencast
+            if self.is_running:
+                try:
+                    await self.cdp.send('Page.screencastFrameAck', {'sessionId': params['sessionId']})
+                except Exception as e:
+                    log.debug("Screencast ack failed: %s", e)
+    
+    async def _emit_frame(self, png_bytes, page_info, retry=True):
+        """Diff a captured frame into tiles and emit the ones that changed"""
+        try:
+            # Frames go out one at a time so tile deltas reach clients in hash order
+            async with self.frame_lock:
+                # Skip the emit entirely when the frame hasn't changed
+                frame_hash = xxhash.xxh3_64_intdigest(png_bytes)
+                if frame_hash == self.last_hash:
+                    # Clients already have this picture, so anything waiting is stale
+                    self.pending_frame = None
+                    return
+                
+                # Clients are still drawing the last frame; keep only the newest one.
+                # It stays undiffed so no tile deltas are lost when it is replaced
+                if self.frame_in_flight:
+                    self.pending_frame = (png_bytes, page_info)
+                    return
+                self.last_hash = frame_hash
+                
+                # Periodically resend every tile so all clients converge
+                baseline = self.needs_baseline or self.frames_since_baseline >= BASELINE_INTERVAL
+                self.needs_baseline = False
+                self.frames_since_baseline = 0 if baseline else self.frames_since_baseline + 1
+                
+                pool = get_encode_pool()
+                try:
+                    width, height, tiles, self.band_hashes, self.tile_hashes = await self.loop.run_in_executor(
+                        pool, encode_tiles, png_bytes, self.band_hashes, self.tile_hashes,
+                        baseline, self.webp_quality
+                    )
+                except Exception as e:
+                    # Nothing went out, so the next emit must neither skip this picture
+                    # nor lose a baseline a newcomer is waiting for
+                    self.last_hash = None
+                    if baseline:
+                        self.needs_baseline = True
+                    
+                    if isinstance(e, BrokenProcessPool):
+                        # A worker was killed (e.g. out of memory); the next encode starts a fresh pool
+                        reset_encode_pool(pool)
+                        # An idle page sends no new frames, so resend the newest one once the
+                        # lock is free; only once, in case it is the frame killing workers
+                        if retry and self.last_frame and self.is_running:
+                            self.loop.create_task(self._emit_frame(*self.last_frame, retry=False))
+                    raise
+                if not tiles:
+                    return
+                
+                # Prepare frame data
+                frame_data = self.frame_data
+                frame_data['tiles'] = tiles
+                frame_data['baseline'] = baseline
+                frame_data['width'] = width
+                frame_data['height'] = height
+                frame_data['pageInfo'] = page_info
+                frame_data['timestamp'] = time.time()
+                
+                self._track_frame_acks()
+                await sio.emit('screenshot-update', frame_data, room=self.room_code,
+                               callback=functools.partial(self._on_frame_ack, self.frame_seq))
             
         except Exception as e:
-            print(f"❌ Screenshot error: {str(e)}")
+            log.error("❌ Screenshot error: %s", e)
     
-    async def _screenshot_loop(self):
-        """Continuous screenshot loop"""
-        print(f"📸 Starting screenshot loop for room {self.room_code}")
+    def _track_frame_acks(self):
+        """Mark a frame as in flight until every client in the room acks it"""
+        room = rooms.get(self.room_code)
+        self.acks_outstanding = len(room.users) if room else 0
+        if not self.acks_outstanding:
+            return
         
-        frame_count = 0
+        self.frame_seq += 1
+        self.frame_in_flight = True
+        self.frame_sent_at = time.monotonic()
+        # A lost ack or a stalled client only holds frames back this long
+        self.ack_timer = self.loop.call_later(FRAME_ACK_TIMEOUT, self._release_frame, self.frame_seq)
+    
+    def _on_frame_ack(self, seq, *args):
+        """Count a client's ack of a frame"""
+        if seq != self.frame_seq:
+            return
+        self.acks_outstanding -= 1
+        if self.acks_outstanding <= 0:
+            self._release_frame(seq)
+    
+    def _release_frame(self, seq):
+        """Let the next frame go out, starting with the one that waited"""
+        if seq != self.frame_seq or not self.frame_in_flight:
+            return
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.frame_in_flight = False
+        
+        # A timed-out frame counts as FRAME_ACK_TIMEOUT, the slowest an ack can be
+        self._update_stream_quality(time.monotonic() - self.frame_sent_at)
+        
+        if self.pending_frame and self.is_running:
+            frame = self.pending_frame
+            self.pending_frame = None
+            self.loop.create_task(self._emit_frame(*frame))
+    
+    def _update_stream_quality(self, ack_time):
+        """Degrade or restore frame quality and rate from how fast clients ack"""
+        self.ack_time_avg = 0.8 * self.ack_time_avg + 0.2 * ack_time
         
+        # The gap between the two thresholds keeps the stream from flapping
+        if not self.degraded and self.ack_time_avg > SLOW_ACK:
+            self.degraded = True
+            self.webp_quality = DEGRADED_WEBP_QUALITY
+            self.frame_skip = DEGRADED_FRAME_SKIP
+        elif self.degraded and self.ack_time_avg < FAST_ACK:
+            self.degraded = False
+            self.webp_quality = WEBP_QUALITY
+            self.frame_skip = 1
+            # Redraw every tile so none stay at the lower quality
+            self.needs_baseline = True
+        else:
+            return
+        
+        log.info("📶 Room %s: %s stream (ack time %.0f ms)", self.room_code,
+                 'degrading' if self.degraded else 'restoring', self.ack_time_avg * 1000)
+        self.loop.create_task(self._restart_screencast())
+    
+    # Command queue
+    def _queue_command(self, func, *args):
+        """Queue a browser coroutine for the command loop"""
+        if self.loop and self.is_running:
+            self.commands.append((func, args))
+            self._wake_command_loop()
+    
+    def _wake_command_loop(self):
+        """Wake the command loop"""
+        if self.command_event:
+            self.command_event.set()
+    
+    async def _command_loop(self):
+        """Run queued commands in batches with one screenshot per batch"""
         while self.is_running and self.page:
             try:
-                await self._take_screenshot()
-                frame_count += 1
+                await self.command_event.wait()
+                self.command_event.clear()
+                
+                commands = list(self.commands)
+                self.commands.clear()
                 
-                if frame_count % 60 == 0:
-                    print(f"📊 Room {self.room_code}: {frame_count} frames captured")
+                if not commands:
+                    continue
                 
-                # 30 FPS
-                await asyncio.sleep(1/30)
+                for func, args in commands:
+                    await func(*args)
+                
+                # Repaints arrive through the screencast; this only catches a frame
+                # that was held back while commands were backed up
+                if self.last_frame:
+                    await self._emit_frame(*self.last_frame)
                 
             except Exception as e:
-                print(f"❌ Screenshot loop error: {str(e)}")
+                log.error("❌ Command loop error: %s", e)
                 await asyncio.sleep(1)
     
     # Navigation methods
     def navigate_to(self, url):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._navigate(url), self.loop)
+        self._queue_command(self._navigate, url)
     
     async def _navigate(self, url):
         try:
             if self.page:
                 self.is_loading = True
-                socketio.emit('loading-state', {'loading': True}, room=self.room_code)
-                print(f"🌐 Navigating to: {url}")
+                await sio.emit('loading-state', {'loading': True}, room=self.room_code)
+                # Bound per-room memory by replacing a worn context while the page
+                # is being replaced anyway, so no scroll position or form state is lost
+                if self._context_is_stale():
+                    await self._recycle_context()
+                    if not self.is_running:
+                        return
+                
+                log.debug("🌐 Navigating to: %s", url)
+                self.navigation_count += 1
                 await self.page.goto(url, wait_until='domcontentloaded')
         except Exception as e:
-            print(f"❌ Navigate error: {e}")
+            log.error("❌ Navigate error: %s", e)
             self.is_loading = False
-            socketio.emit('loading-state', {'loading': False}, room=self.room_code)
+            await sio.emit('loading-state', {'loading': False}, room=self.room_code)
     
     def go_back(self):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._go_back(), self.loop)
+        self._queue_command(self._go_back)
     
     async def _go_back(self):
         try:
             if self.page:
                 await self.page.go_back(wait_until='domcontentloaded')
         except Exception as e:
-            print(f"❌ Go back error: {e}")
+            log.error("❌ Go back error: %s", e)
     
     def go_forward(self):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._go_forward(), self.loop)
+        self._queue_command(self._go_forward)
     
     async def _go_forward(self):
         try:
             if self.page:
                 await self.page.go_forward(wait_until='domcontentloaded')
         except Exception as e:
-            print(f"❌ Go forward error: {e}")
+            log.error("❌ Go forward error: %s", e)
     
     def reload(self):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._reload(), self.loop)
+        self._queue_command(self._reload)
     
     async def _reload(self):
         try:
             if self.page:
                 await self.page.reload(wait_until='domcontentloaded')
         except Exception as e:
-            print(f"❌ Reload error: {e}")
+            log.error("❌ Reload error: %s", e)
     
     # Input methods
     def click_at(self, x, y):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._click(x, y), self.loop)
+        self._queue_command(self._click, x, y)
     
     async def _click(self, x, y):
         try:
             if self.page:
-                print(f"🖱️ Clicking at: ({x}, {y})")
+                log.debug("🖱️ Clicking at: (%s, %s)", x, y)
                 await self.page.mouse.click(x, y)
-                await asyncio.sleep(0.1)
-                await self._take_screenshot()
         except Exception as e:
-            print(f"❌ Click error: {e}")
+            log.error("❌ Click error: %s", e)
     
     def scroll_to(self, x, y):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._scroll(x, y), self.loop)
+        # Scroll bursts collapse into a single scrollTo, but only while it is the
+        # newest command, so a click after a scroll still lands on scrolled content
+        if self.commands and self.commands[-1][0] == self._scroll:
+            self.commands[-1] = (self._scroll, (x, y))
+            return
+        self._queue_command(self._scroll, x, y)
     
     async def _scroll(self, x, y):
         try:
             if self.page:
-                print(f"📜 Scrolling to: ({x}, {y})")
+                log.debug("📜 Scrolling to: (%s, %s)", x, y)
                 await self.page.evaluate(f"window.scrollTo({x}, {y})")
-                await asyncio.sleep(0.1)
-                await self._take_screenshot()
         except Exception as e:
-            print(f"❌ Scroll error: {e}")
+            log.error("❌ Scroll error: %s", e)
     
     def scroll_by(self, delta_x, delta_y):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._scroll_by(delta_x, delta_y), self.loop)
+        # Wheel bursts add onto a wheel command that is still queued instead of
+        # queuing one per event; only the newest command can merge, so order is kept
+        if self.commands and self.commands[-1][0] == self._scroll_by:
+            queued_x, queued_y = self.commands[-1][1]
+            self.commands[-1] = (self._scroll_by, (queued_x + delta_x, queued_y + delta_y))
+            return
+        self._queue_command(self._scroll_by, delta_x, delta_y)
     
     async def _scroll_by(self, delta_x, delta_y):
         try:
             if self.page:
                 await self.page.mouse.wheel(delta_x, delta_y)
-                await asyncio.sleep(0.1)
-                await self._take_screenshot()
         except Exception as e:
-            print(f"❌ Scroll by error: {e}")
+            log.error("❌ Scroll by error: %s", e)
     
     # Keyboard methods
     def type_text(self, text):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._type_text(text), self.loop)
+        self._queue_command(self._type_text, text)
     
     async def _type_text(self, text):
         try:
             if self.page:
-                print(f"⌨️ Typing: {text}")
+                log.debug("⌨️ Typing: %s", text)
                 await self.page.keyboard.type(text)
-                await asyncio.sleep(0.1)
-                await self._take_screenshot()
         except Exception as e:
-            print(f"❌ Type error: {e}")
+            log.error("❌ Type error: %s", e)
     
     def press_key(self, key):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._press_key(key), self.loop)
+        self._queue_command(self._press_key, key)
     
     async def _press_key(self, key):
         try:
             if self.page:
-                print(f"⌨️ Pressing key: {key}")
+                log.debug("⌨️ Pressing key: %s", key)
                 await self.page.keyboard.press(key)
-                await asyncio.sleep(0.1)
-                await self._take_screenshot()
         except Exception as e:
-            print(f"❌ Key press error: {e}")
+            log.error("❌ Key press error: %s", e)
     
     def key_combination(self, keys):
-        if self.loop and self.is_running:
-            asyncio.run_coroutine_threadsafe(self._key_combination(keys), self.loop)
+        self._queue_command(self._key_combination, keys)
     
     async def _key_combination(self, keys):
         try:
             if self.page:
-                print(f"⌨️ Key combination: {'+'.join(keys)}")
+                # The join would run even with debug logging off
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("⌨️ Key combination: %s", '+'.join(keys))
                 
                 # Press all keys down
                 for key in keys:
@@ -468,11 +1014,17 @@ class FullVirtualBrowser:
                 # Release all keys
                 for key in reversed(keys):
                     await self.page.keyboard.up(key)
-                
-                await asyncio.sleep(0.1)
-                await self._take_screenshot()
         except Exception as e:
-            print(f"❌ Key combination error: {e}")
+            log.error("❌ Key combination error: %s", e)
+    
+    def request_full_frame(self):
+        """Send a full baseline now, even if the page hasn't changed"""
+        self.last_hash = None
+        self.needs_baseline = True
+        
+        # An idle page produces no screencast frames, so resend the newest one
+        if self.last_frame and self.is_running:
+            self.loop.create_task(self._emit_frame(*self.last_frame))
     
     def set_url_typing_state(self, is_typing):
         """Set whether user is currently typing in URL bar"""
@@ -481,24 +1033,34 @@ class FullVirtualBrowser:
     def stop(self):
         """Stop the browser"""
         self.is_running = False
+        self.is_stopped = True
         
         if self.loop:
-            asyncio.run_coroutine_threadsafe(self._cleanup(), self.loop)
-            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._wake_command_loop()
+            self.loop.create_task(self._cleanup())
         
-        print(f"🛑 Full browser stopped for room {self.room_code}")
+        log.info("🛑 Full browser stopped for room %s", self.room_code)
     
     async def _cleanup(self):
         """Cleanup browser resources"""
-        try:
-            if self.context:
-                await self.context.close()
-            if self.browser:
-                await self.browser.close()
-            if self.playwright:
-                await self.playwright.stop()
-        except Exception as e:
-            print(f"❌ Cleanup error: {e}")
+        async with self.context_lock:
+            await self._release_browser()
+        
+        self.executor.shutdown(wait=False)
+        
+        if self.ack_timer:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.page_info_update:
+            self.page_info_update.cancel()
+            self.page_info_update = None
+        
+        # Drop per-frame state so a lingering reference doesn't pin it
+        self.band_hashes = None
+        self.tile_hashes = None
+        self.page_info = None
+        self.pending_frame = None
+        self.last_frame = None
 
 # Flask routes
 @app.route('/')
@@ -509,249 +1071,217 @@ def index():
 def room_page(room_code):
     return render_template('room.html', room_code=room_code)
 
+# Static part of the health response, built once
+HEALTH_INFO = {
+    'status': 'ok',
+    'technology': 'Playwright Full Browser',
+    'features': ['typing', 'scrolling', 'clicking', 'navigation', 'keyboard_shortcuts', 'forms']
+}
+
 @app.route('/health')
 def health():
     return jsonify({
-        'status': 'ok',
-        'technology': 'Playwright Full Browser',
-        'rooms': len(rooms_data),
-        'active_browsers': len(browser_instances),
-        'features': ['typing', 'scrolling', 'clicking', 'navigation', 'keyboard_shortcuts', 'forms']
+        **HEALTH_INFO,
+        'rooms': len(rooms),
+        # Runs on a WSGI thread; snapshot rather than iterate the live dict
+        'active_browsers': sum(1 for room in list(rooms.values()) if room.browser),
+        'timestamp': time.time()
     })
 
 @app.route('/api/room/<room_code>')
 def get_room_info(room_code):
-    room = rooms_data.get(room_code)
+    room = rooms.get(room_code)
     if room:
         return jsonify({
             'roomCode': room_code,
-            'userCount': len(room['users']),
-            'contentUrl': room['webtoon_url'],
+            'userCount': len(room.users),
+            'contentUrl': room.webtoon_url,
             'exists': True
         })
     else:
         return jsonify({'error': 'Room not found', 'exists': False}), 404
 
 # Socket events
-@socketio.on('connect')
-def on_connect():
-    print(f'👤 User connected: {request.sid}')
-
-@socketio.on('disconnect')
-def on_disconnect():
-    print(f'👤 User disconnected: {request.sid}')
-    if request.sid in user_sessions:
-        user_data = user_sessions[request.sid]
-        handle_user_leave(request.sid, user_data.get('room_code'))
-
-@socketio.on('join-room')
-def on_join_room(data):
+@sio.on('connect')
+async def on_connect(sid, environ):
+    log.info('👤 User connected: %s', sid)
+
+@sio.on('disconnect')
+async def on_disconnect(sid):
+    log.info('👤 User disconnected: %s', sid)
+    user_data = user_sessions.get(sid)
+    if user_data:
+        await handle_user_leave(sid, user_data.get('room_code'))
+
+@sio.on('join-room')
+async def on_join_room(sid, data):
     room_code = data['roomCode']
     user_name = data['userName']
     is_creator = data.get('isCreator', False)
     
-    print(f'👤 {user_name} joining FULL browser room {room_code}')
+    log.info('👤 %s joining FULL browser room %s', user_name, room_code)
     
-    join_room(room_code)
+    sio.enter_room(sid, room_code)
     
-    user_sessions[request.sid] = {
+    # Everything up to the broadcast runs without awaiting, so room creation
+    # and membership changes can't interleave with other handlers
+    user_sessions[sid] = {
         'user_name': user_name,
         'room_code': room_code,
         'is_creator': is_creator
     }
     
-    if room_code not in rooms_data:
+    room = rooms.get(room_code)
+    if room is None:
         if is_creator:
             default_url = 'https://www.webtoon.com'
-            print(f'🏠 Creating FULL browser room {room_code}')
-            rooms_data[room_code] = {
-                'users': {},
-                'messages': [],
-                'webtoon_url': default_url,
-                'created_at': time.time(),
-                'creator': user_name
-            }
-            
-            browser = FullVirtualBrowser(room_code, default_url)
-            browser_instances[room_code] = browser
+            log.info('🏠 Creating FULL browser room %s', room_code)
+            room = rooms[room_code] = Room(default_url, user_name)
+            room.browser = FullVirtualBrowser(room_code, default_url)
             
-            success = browser.start()
+            success = room.browser.start()
             if not success:
-                emit('browser-error', {'error': 'Failed to start browser'})
+                await sio.emit('browser-error', {'error': 'Failed to start browser'}, to=sid)
                 return
         else:
-            emit('room-not-found')
+            await sio.emit('room-not-found', to=sid)
             return
     
-    room = rooms_data[room_code]
-    room['users'][request.sid] = {'id': request.sid, 'userName': user_name}
+    room.users[sid] = {'id': sid, 'userName': user_name}
     
-    room_users = list(room['users'].values())
-    emit('room-users', room_users)
-    emit('webtoon-url-update', {'url': room['webtoon_url']})
+    # Unchanged frames are never re-sent, so make sure the newcomer gets one
+    if room.browser:
+        room.browser.request_full_frame()
     
-    emit('user-joined', {'userName': user_name}, room=room_code, include_self=False)
-    emit('room-users', room_users, room=room_code, include_self=False)
+    # One broadcast tells everyone, the newcomer included, who is in the room
+    await sio.emit('room-sync', {
+        'users': list(room.users.values()),
+        'joined': user_name,
+        'url': room.webtoon_url
+    }, room=room_code)
 
 # Browser control events
-@socketio.on('browser-navigate')
-def on_browser_navigate(data):
-    room_code = data['roomCode']
+def with_room_browser(handler):
+    """Look up the event's room once and pass it in, ignoring rooms without a browser"""
+    @functools.wraps(handler)
+    async def wrapper(sid, data):
+        room = rooms.get(data.get('roomCode'))
+        if room is None or room.browser is None:
+            return
+        return await handler(sid, data, room)
+    return wrapper
+
+@sio.on('browser-navigate')
+@with_room_browser
+async def on_browser_navigate(sid, data, room):
     url = data['url']
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.navigate_to(url)
-        
-        if room_code in rooms_data:
-            rooms_data[room_code]['webtoon_url'] = url
+    room.browser.navigate_to(url)
+    room.webtoon_url = url
 
-@socketio.on('url-typing-start')
-def on_url_typing_start(data):
-    room_code = data['roomCode']
-    
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.set_url_typing_state(True)
+@sio.on('url-typing-start')
+@with_room_browser
+async def on_url_typing_start(sid, data, room):
+    room.browser.set_url_typing_state(True)
 
-@socketio.on('url-typing-stop')
-def on_url_typing_stop(data):
-    room_code = data['roomCode']
-    
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.set_url_typing_state(False)
+@sio.on('url-typing-stop')
+@with_room_browser
+async def on_url_typing_stop(sid, data, room):
+    room.browser.set_url_typing_state(False)
 
-@socketio.on('browser-back')
-def on_browser_back(data):
-    room_code = data['roomCode']
-    
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.go_back()
+@sio.on('browser-back')
+@with_room_browser
+async def on_browser_back(sid, data, room):
+    room.browser.go_back()
 
-@socketio.on('browser-forward')
-def on_browser_forward(data):
-    room_code = data['roomCode']
-    
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.go_forward()
+@sio.on('browser-forward')
+@with_room_browser
+async def on_browser_forward(sid, data, room):
+    room.browser.go_forward()
 
-@socketio.on('browser-reload')
-def on_browser_reload(data):
-    room_code = data['roomCode']
-    
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.reload()
+@sio.on('browser-reload')
+@with_room_browser
+async def on_browser_reload(sid, data, room):
+    room.browser.reload()
 
-@socketio.on('browser-click')
-def on_browser_click(data):
-    room_code = data['roomCode']
+@sio.on('browser-click')
+@with_room_browser
+async def on_browser_click(sid, data, room):
     x = data.get('x', 0)
     y = data.get('y', 0)
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.click_at(x, y)
+    room.browser.click_at(x, y)
 
-@socketio.on('browser-scroll')
-def on_browser_scroll(data):
-    room_code = data['roomCode']
+@sio.on('browser-scroll')
+@with_room_browser
+async def on_browser_scroll(sid, data, room):
     x = data.get('x', 0)
     y = data.get('y', 0)
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.scroll_to(x, y)
+    room.browser.scroll_to(x, y)
 
-@socketio.on('browser-scroll-by')
-def on_browser_scroll_by(data):
-    room_code = data['roomCode']
+@sio.on('browser-scroll-by')
+@with_room_browser
+async def on_browser_scroll_by(sid, data, room):
     delta_x = data.get('deltaX', 0)
     delta_y = data.get('deltaY', 0)
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.scroll_by(delta_x, delta_y)
+    room.browser.scroll_by(delta_x, delta_y)
 
-@socketio.on('browser-type')
-def on_browser_type(data):
-    room_code = data['roomCode']
+@sio.on('browser-type')
+@with_room_browser
+async def on_browser_type(sid, data, room):
     text = data['text']
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.type_text(text)
+    room.browser.type_text(text)
 
-@socketio.on('browser-key')
-def on_browser_key(data):
-    room_code = data['roomCode']
+@sio.on('browser-key')
+@with_room_browser
+async def on_browser_key(sid, data, room):
     key = data['key']
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.press_key(key)
+    room.browser.press_key(key)
 
-@socketio.on('browser-key-combo')
-def on_browser_key_combo(data):
-    room_code = data['roomCode']
+@sio.on('browser-key-combo')
+@with_room_browser
+async def on_browser_key_combo(sid, data, room):
     keys = data['keys']
     
-    if room_code in browser_instances:
-        browser = browser_instances[room_code]
-        browser.key_combination(keys)
+    room.browser.key_combination(keys)
 
-@socketio.on('chat-message')
-def on_chat_message(data):
+@sio.on('chat-message')
+async def on_chat_message(sid, data):
     room_code = data['roomCode']
     message = data['message']
     
     message_with_id = {**message, 'id': str(uuid.uuid4())}
     
-    if room_code in rooms_data:
-        room = rooms_data[room_code]
-        room['messages'].append(message_with_id)
-        if len(room['messages']) > 100:
-            room['messages'] = room['messages'][-100:]
+    room = rooms.get(room_code)
+    if room:
+        room.messages.append(message_with_id)
     
-    emit('chat-message', message_with_id, room=room_code)
+    await sio.emit('chat-message', message_with_id, room=room_code)
 
-def handle_user_leave(session_id, room_code):
-    if not room_code or room_code not in rooms_data:
-        return
+async def handle_user_leave(session_id, room_code):
+    user_sessions.pop(session_id, None)
     
-    room = rooms_data[room_code]
+    room = rooms.get(room_code) if room_code else None
+    if not room or session_id not in room.users:
+        return
     
-    if session_id in room['users']:
-        user = room['users'][session_id]
-        del room['users'][session_id]
-        
-        emit('user-left', user, room=room_code)
-        
-        room_users = list(room['users'].values())
-        emit('room-users', room_users, room=room_code)
-        
-        if len(room['users']) == 0:
-            if room_code in browser_instances:
-                browser = browser_instances[room_code]
-                browser.stop()
-                del browser_instances[room_code]
-            
-            del rooms_data[room_code]
-            print(f'🧹 Room {room_code} cleaned up')
+    user = room.users.pop(session_id)
+    room_users = list(room.users.values())
     
-    if session_id in user_sessions:
-        del user_sessions[session_id]
-
-if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5000))
+    # Drop an empty room before awaiting so no joiner can land in it
+    if not room_users:
+        del rooms[room_code]
     
-    print('🚀 Starting FULL Virtual Browser Server')
-    print(f'📡 Server running on port {port}')
-    print('🎭 Technology: Playwright FULL Browser')
-    print('⌨️ Features: Typing, Scrolling, Clicking, Navigation, Keyboard Shortcuts, Forms')
-    print('🌐 Full browser functionality enabled!')
+    await sio.emit('room-sync', {
+        'users': room_users,
+        'left': user['userName']
+    }, room=room_code)
     
-    socketio.run(app, host='0.0.0.0', port=port, debug=True)
+    if not room_users:
+        if room.browser:
+            room.browser.stop()
+        log.info('🧹 Room %s cleaned up', room_code)
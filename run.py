@@ -0,0 +1,21 @@
+"""Start the server.
+
+A separate entry point so app.py is never the __main__ module; encoder
+workers are spawned and re-run __main__, and this one imports nothing
+heavy at module scope. uvicorn imports app.py itself from the string below.
+"""
+import os
+import sys
+import uvicorn
+
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 5000))
+    print('🚀 Starting FULL Virtual Browser Server')
+    print(f'📡 Server running on port {port}')
+    print('🎭 Technology: Playwright FULL Browser')
+    print('⌨️ Features: Typing, Scrolling, Clicking, Navigation, Keyboard Shortcuts, Forms')
+    print('🌐 Full browser functionality enabled!')
+    
+    # uvloop is a faster drop-in loop for the Playwright and Socket.IO traffic; it has no Windows build
+    loop = 'asyncio' if sys.platform == 'win32' else 'uvloop'
+    uvicorn.run('app:asgi_app', host='0.0.0.0', port=port, loop=loop)
@@ -0,0 +1,49 @@
+"""Frame tile encoding, run in the encoder worker processes.
+
+Kept apart from app.py so spawned workers import only OpenCV, NumPy and
+xxhash, not Flask, Socket.IO and Playwright.
+"""
+import cv2
+import numpy as np
+import xxhash
+
+# Frames are diffed and sent as square tiles of this size
+TILE_SIZE = 128
+
+def encode_tiles(png_bytes, band_hashes, tile_hashes, baseline, quality):
+    """Decode a PNG frame and WebP-encode the tiles that changed since the given hashes"""
+    frame = cv2.imdecode(np.frombuffer(png_bytes, np.uint8), cv2.IMREAD_COLOR)
+    
+    height, width = frame.shape[:2]
+    rows = -(-height // TILE_SIZE)
+    cols = -(-width // TILE_SIZE)
+    
+    # Forget old hashes on a baseline or when the viewport size changes
+    if baseline or tile_hashes is None or len(tile_hashes) != rows or len(tile_hashes[0]) != cols:
+        band_hashes = [None] * rows
+        tile_hashes = [[None] * cols for _ in range(rows)]
+    
+    webp_params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    tiles = []
+    for ty in range(rows):
+        # A full-width band is contiguous, so it hashes without a copy; only
+        # bands that changed are split into tiles, which bounds the dirty region
+        band = frame[ty * TILE_SIZE:(ty + 1) * TILE_SIZE]
+        band_hash = xxhash.xxh3_64_intdigest(band)
+        if band_hash == band_hashes[ty]:
+            continue
+        band_hashes[ty] = band_hash
+        
+        for tx in range(cols):
+            tile = band[:, tx * TILE_SIZE:(tx + 1) * TILE_SIZE]
+            tile_hash = xxhash.xxh3_64_intdigest(tile.tobytes())
+            if tile_hash == tile_hashes[ty][tx]:
+                continue
+            tile_hashes[ty][tx] = tile_hash
+            
+            ok, encoded = cv2.imencode('.webp', tile, webp_params)
+            if ok:
+                tiles.append([tx, ty, encoded.tobytes()])
+    
+    # The worker's copy of the hashes goes back to the room that owns them
+    return width, height, tiles, band_hashes, tile_hashes